@@ -1,8 +1,70 @@
 import streamlit as st
+import contextlib
+import copy
+import errno
 import os
 import tempfile
 import subprocess
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Let the CUDA allocator grow segments instead of fragmenting, set before torch starts CUDA
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128")
+
+import soundfile as sf
+import torch
+from blake3 import blake3
+from demucs import hdemucs, htdemucs
+from demucs.apply import BagOfModels, TensorChunk, apply_model
+from demucs.audio import AudioFile, prevent_clip
+from demucs.htdemucs import HTDemucs
+from demucs.pretrained import get_model
+from demucs.utils import center_trim
+
+# Run on the GPU when there is one, otherwise spread segments over every core.
+# The workers are threads and the script thread only waits on them, so no core is kept back.
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+JOBS = os.cpu_count() or 1
+if DEVICE == "cpu":
+    # Each segment worker gets one core, so torch ops run single-threaded inside it
+    torch.set_num_threads(1)
+DEFAULT_SEGMENT = 15
+
+# Shorter segments to retry with when the GPU runs out of memory
+OOM_SEGMENTS = [15, 10, 7]
+
+# Rough activation memory per byte of input audio, used to size GPU batches
+MODEL_MEMORY_FACTOR = 1000
+MAX_BATCH_SIZE = 8
+
+# Keep scratch files in RAM when there is a tmpfs big enough for a few separations
+# (Docker's default 64MB /dev/shm is not). Decided on its total size, not free space,
+# so the choice never flips once the cache itself fills it and strands what's there.
+TMP_ROOT = None
+if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").total >= 2 * 1024 ** 3:
+    TMP_ROOT = "/dev/shm"
+
+# Stems outlive the click so downloads can be encoded on demand and
+# repeated separations of the same upload can be served from disk
+CACHE_DIR = os.path.join(TMP_ROOT or tempfile.gettempdir(), "vocal-separator")
+os.makedirs(CACHE_DIR, exist_ok=True)
+MAX_CACHED_SEPARATIONS = 4
+# Partial directories untouched for this long belong to a crashed run
+PARTIAL_MAX_AGE = 30 * 60
+
+MODELS = ["htdemucs", "mdx_extra", "mdx_q"]
+# Models kept in memory at once; mdx_extra and mdx_q are bags of four networks
+MAX_LOADED_MODELS = 2
+
+STEMS = {
+    "vocals": "🎤 Vocals",
+    "drums": "🥁 Drums",
+    "bass": "🎸 Bass",
+    "other": "🎹 Other",
+}
 
 st.set_page_config(
     page_title="Vocal Separator",
@@ -10,6 +72,506 @@ st.set_page_config(
     layout="wide"
 )
 
+
+@st.cache_resource
+def patch_spectrogram():
+    """Swap demucs' spectro/ispectro for versions that reuse their Hann windows.
+
+    Runs once per process: reruns would otherwise rebind the patched functions,
+    and the compiled networks, which guard on them, would recompile every click.
+    Returns the window cache, one window per size, device and dtype.
+    """
+    windows = {}
+
+    def hann_window(size, like):
+        """A cached torch.hann_window matching the device and dtype of `like`."""
+        key = (size, like.device, like.dtype)
+        if key not in windows:
+            windows[key] = torch.hann_window(size, device=like.device, dtype=like.dtype)
+        return windows[key]
+
+    def cached_spectro(x, n_fft=512, hop_length=None, pad=0):
+        """demucs.spec.spectro without allocating a new window for every segment."""
+        *other, length = x.shape
+        x = x.reshape(-1, length)
+        z = torch.stft(
+            x,
+            n_fft * (1 + pad),
+            hop_length or n_fft // 4,
+            window=hann_window(n_fft, x),
+            win_length=n_fft,
+            normalized=True,
+            center=True,
+            return_complex=True,
+            pad_mode="reflect"
+        )
+        _, freqs, frame = z.shape
+        return z.view(*other, freqs, frame)
+
+    def cached_ispectro(z, hop_length=None, length=None, pad=0):
+        """demucs.spec.ispectro without allocating a new window for every segment."""
+        *other, freqs, frames = z.shape
+        n_fft = 2 * freqs - 2
+        z = z.view(-1, freqs, frames)
+        win_length = n_fft // (1 + pad)
+        x = torch.istft(
+            z,
+            n_fft,
+            hop_length,
+            window=hann_window(win_length, z.real),
+            win_length=win_length,
+            normalized=True,
+            length=length,
+            center=True
+        )
+        _, length = x.shape
+        return x.view(*other, length)
+
+    # The hybrid models import spectro/ispectro by name, so patch them where they are used
+    hdemucs.spectro, hdemucs.ispectro = cached_spectro, cached_ispectro
+    htdemucs.spectro, htdemucs.ispectro = cached_spectro, cached_ispectro
+    return windows
+
+
+patch_spectrogram()
+
+
+@st.cache_resource(show_spinner=False, max_entries=MAX_LOADED_MODELS)
+def load_model(model_name):
+    """Load a pretrained Demucs model once and keep it in memory across reruns."""
+    try:
+        separator = get_model(model_name)
+    except SystemExit as error:
+        # demucs exits when a model needs a missing package (diffq for mdx_q), which
+        # would end the script run without a message
+        raise RuntimeError(f"Could not load {model_name}, see the server log for why") from error
+    separator.to(DEVICE)
+    separator.eval()
+    if DEVICE == "cuda":
+        compile_model(separator, model_name)
+    return separator
+
+
+def compile_model(separator, model_name):
+    """Compile each network and warm it up on one silent segment.
+
+    CUDA graphs are left out: Streamlit runs every rerun on a new script thread and
+    torch keeps captured graphs per thread, so they would never be replayed.
+    """
+    # Fall back to eager mode for anything torch.compile can't handle
+    torch._dynamo.config.suppress_errors = True
+    networks = separator.models if isinstance(separator, BagOfModels) else [separator]
+    for network in networks:
+        # Replace forward rather than the module so apply_model still sees the model class
+        network.forward = torch.compile(network.forward)
+
+    segment = min(DEFAULT_SEGMENT, max_segment(separator))
+    silence = torch.zeros(separator.audio_channels, int(segment * separator.samplerate))
+    try:
+        with torch.no_grad(), inference_context():
+            apply_batched(separator, silence, segment, 0, gpu_batch_size(separator, model_name, segment))
+    except torch.cuda.OutOfMemoryError:
+        # Keep the model un-warmed, run_model shrinks the work or falls back to the CPU
+        pass
+    torch.cuda.empty_cache()
+
+
+def max_segment(separator):
+    """Longest segment in seconds the model accepts (transformer models cap it)."""
+    if isinstance(separator, HTDemucs):
+        return float(separator.segment)
+    if isinstance(separator, BagOfModels):
+        return separator.max_allowed_segment
+    return float("inf")
+
+
+def download_format(filename):
+    """Pick the download format for an upload: WAV for lossless sources, MP3 otherwise.
+
+    Returns the file extension and the LAME VBR quality, which is None for WAV.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in (".wav", ".flac"):
+        return "wav", None
+    # Lossy sources other than MP3 already lost detail, a smaller MP3 is enough
+    return "mp3", 2 if ext == ".mp3" else 4
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def to_mp3(wav_path, mtime, quality):
+    """Encode a WAV stem to MP3 with FFmpeg; mtime ties the result to one separation."""
+    mp3_path = f"{os.path.splitext(wav_path)[0]}-q{quality}.mp3"
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-i", wav_path,
+         "-c:a", "libmp3lame", "-q:a", str(quality), mp3_path],
+        check=True
+    )
+    return mp3_path
+
+
+def stem_download(wav_path, quality):
+    """Deferred download data: the WAV as is, or encoded to MP3 only when clicked."""
+    if quality is not None:
+        wav_path = to_mp3(wav_path, os.path.getmtime(wav_path), quality)
+    with open(wav_path, "rb") as f:
+        return f.read()
+
+
+def fast_bag(separator):
+    """Reduce a bag of models to one network per source, the one weighted highest for it.
+
+    Ties go to the earliest network. mdx_extra ships uniform weights, so it runs
+    its first network alone; mdx_q keeps two of its four networks.
+    """
+    if not isinstance(separator, BagOfModels) or len(separator.models) == 1:
+        return separator
+    sources = range(len(separator.sources))
+    best = [max(range(len(separator.models)), key=lambda n: separator.weights[n][k]) for k in sources]
+    picked = sorted(set(best))
+    weights = [[float(best[k] == n) for k in sources] for n in picked]
+    return BagOfModels([separator.models[n] for n in picked], weights)
+
+
+def cpu_copy(separator):
+    """Private eager copy of a model on the CPU, leaving the shared GPU model as it is."""
+    networks = separator.models if isinstance(separator, BagOfModels) else [separator]
+    # Seed deepcopy with CPU tensors so copying never allocates VRAM
+    memo = {id(p): torch.nn.Parameter(p.detach().cpu(), requires_grad=False) for p in separator.parameters()}
+    memo.update({id(b): b.cpu() for b in separator.buffers()})
+    # Skip the compiled forwards, they are tied to the GPU model
+    memo.update({id(network.__dict__["forward"]): None for network in networks if "forward" in network.__dict__})
+    copied = copy.deepcopy(separator, memo)
+    for network in copied.models if isinstance(copied, BagOfModels) else [copied]:
+        network.__dict__.pop("forward", None)
+    return copied
+
+
+@st.cache_resource(show_spinner=False)
+def gpu_batch_size(_separator, model_name, segment):
+    """How many segments fit in free VRAM at once, from a rough per-segment cost.
+
+    Worked out once per model and segment, so runs at the default segment feed
+    the compiled networks the same shape as the warm-up. Other segment lengths
+    are new shapes and compile once more on their first run.
+    """
+    free_bytes, _ = torch.cuda.mem_get_info()
+    segment_bytes = int(segment * _separator.samplerate) * _separator.audio_channels * 4
+    return int(max(1, min(MAX_BATCH_SIZE, free_bytes // (segment_bytes * MODEL_MEMORY_FACTOR))))
+
+
+def stage_batch(mix, offsets, segment_length, buffer, copy_stream):
+    """Pack padded segments into a pinned buffer and start copying it to the GPU.
+
+    Rows past the last segment are zeroed so every forward has the same shape.
+    """
+    chunks = [TensorChunk(mix, offset, segment_length) for offset in offsets]
+    for row, chunk in enumerate(chunks):
+        buffer[row].copy_(chunk.padded(buffer.shape[-1]))
+    buffer[len(chunks):].zero_()
+    with torch.cuda.stream(copy_stream):
+        batch = buffer.to(DEVICE, non_blocking=True)
+    return chunks, batch
+
+
+def apply_batched(separator, mix, segment, overlap, batch_size, on_progress=None):
+    """Overlap-add separation like demucs' apply_model, with batch_size segments per forward."""
+    if isinstance(separator, BagOfModels):
+        networks, bag_weights = separator.models, separator.weights
+    else:
+        networks, bag_weights = [separator], [[1.0] * len(separator.sources)]
+
+    channels, length = mix.shape
+    segment_length = int(separator.samplerate * segment)
+    stride = int((1 - overlap) * segment_length)
+    offsets = range(0, length, stride)
+
+    # Triangle window so overlapping segments cross-fade into each other
+    window = torch.cat([
+        torch.arange(1, segment_length // 2 + 1),
+        torch.arange(segment_length - segment_length // 2, 0, -1)
+    ]).float()
+    window /= window.max()
+    sum_window = torch.zeros(length)
+    for offset in offsets:
+        sum_window[offset:offset + segment_length] += window[:length - offset]
+
+    estimates = torch.zeros(len(separator.sources), channels, length)
+    copy_stream = torch.cuda.Stream()
+    for network_index, (network, source_weights) in enumerate(zip(networks, bag_weights)):
+        # Same padding as apply_model: HDemucs has no valid_length and takes the chunk as is
+        if isinstance(network, HTDemucs) or not hasattr(network, "valid_length"):
+            valid_length = segment_length
+        else:
+            valid_length = network.valid_length(segment_length)
+
+        # Two pinned buffers, so the next batch uploads while the current one runs
+        pinned = [
+            torch.empty(batch_size, channels, valid_length, pin_memory=True)
+            for _ in range(2)
+        ]
+        starts = range(0, len(offsets), batch_size)
+        total = len(networks) * len(starts)
+        staged = stage_batch(mix, offsets[:batch_size], segment_length, pinned[0], copy_stream)
+
+        out = torch.zeros_like(estimates)
+        for index, start in enumerate(starts):
+            chunks, batch = staged
+            torch.cuda.current_stream().wait_stream(copy_stream)
+            batch.record_stream(torch.cuda.current_stream())
+            with torch.no_grad():
+                batch_out = network(batch)
+            if index + 1 < len(starts):
+                next_offsets = offsets[start + batch_size:start + 2 * batch_size]
+                staged = stage_batch(mix, next_offsets, segment_length, pinned[(index + 1) % 2], copy_stream)
+            # Copying the result back waits for this forward, by then the next upload is queued
+            batch_out = batch_out.float().cpu()
+            for chunk, chunk_out in zip(chunks, batch_out):
+                out[..., chunk.offset:chunk.offset + chunk.length] += (
+                    window[:chunk.length] * center_trim(chunk_out, chunk.length))
+            if on_progress:
+                done = network_index * len(starts) + index + 1
+                on_progress(done / total)
+        estimates += torch.tensor(source_weights)[:, None, None] * out
+
+    estimates /= torch.tensor(bag_weights).sum(0)[:, None, None]
+    estimates /= sum_window
+    return estimates
+
+
+def inference_context():
+    """Mixed precision on the GPU, plain FP32 on the CPU."""
+    if DEVICE == "cuda":
+        # Only Ampere and newer have BF16 tensor cores, older cards would emulate it
+        dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+        return torch.autocast(device_type="cuda", dtype=dtype)
+    return contextlib.nullcontext()
+
+
+class ProgressPool:
+    """Executor wrapper for apply_model that reports each segment as its result is taken.
+
+    apply_model collects results in order on the calling thread, so on_progress
+    runs on the script thread and can update Streamlit elements.
+    """
+
+    class Result:
+        def __init__(self, pool, future):
+            self.pool = pool
+            self.future = future
+
+        def result(self):
+            value = self.future.result()
+            self.pool.done += 1
+            self.pool.on_progress(min(1.0, self.pool.done / self.pool.total))
+            return value
+
+    def __init__(self, executor, total, on_progress):
+        self.executor = executor
+        self.total = total
+        self.done = 0
+        self.on_progress = on_progress
+
+    def submit(self, func, *args, **kwargs):
+        return ProgressPool.Result(self, self.executor.submit(func, *args, **kwargs))
+
+
+def run_model(separator, wav, segment, overlap, batch_size, on_progress):
+    """Separate on the GPU, shrinking the work on CUDA OOM before falling back to the CPU."""
+    if DEVICE == "cuda":
+        attempts = [(segment, batch_size)]
+        if batch_size > 1:
+            attempts.append((segment, 1))
+        networks = separator.models if isinstance(separator, BagOfModels) else [separator]
+        # HTDemucs pads every segment back to its training length, shorter ones save nothing
+        if not all(isinstance(network, HTDemucs) for network in networks):
+            attempts += [(shorter, 1) for shorter in OOM_SEGMENTS if shorter < segment]
+        for attempt_segment, batch_size in attempts:
+            try:
+                return apply_batched(separator, wav, attempt_segment, overlap, batch_size, on_progress)
+            except torch.cuda.OutOfMemoryError:
+                pass
+            # Only once the exception is gone are the failed attempt's tensors free to release
+            torch.cuda.empty_cache()
+
+        # Torch keeps its full thread pool on GPU hosts, give each segment worker one core
+        threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        try:
+            return apply_cpu(cpu_copy(separator), wav, segment, overlap, on_progress)
+        finally:
+            torch.set_num_threads(threads)
+    return apply_cpu(separator, wav, segment, overlap, on_progress)
+
+
+def apply_cpu(separator, wav, segment, overlap, on_progress):
+    """Separate with demucs' apply_model, spreading segments over JOBS worker threads."""
+    networks = len(separator.models) if isinstance(separator, BagOfModels) else 1
+    stride = int((1 - overlap) * int(separator.samplerate * segment))
+    total = networks * len(range(0, wav.shape[-1], stride))
+    executor = ThreadPoolExecutor(JOBS)
+    try:
+        sources = apply_model(
+            separator,
+            wav[None],
+            device="cpu",
+            segment=segment,
+            overlap=overlap,
+            shifts=0,
+            pool=ProgressPool(executor, total, on_progress)
+        )[0]
+    except BaseException:
+        # apply_model queued every segment up front, drop them rather than finish the track
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return sources
+
+
+def separate_track(separator, input_path, output_dir, segment, overlap, batch_size, on_progress):
+    """Run the model in-process and write one WAV per stem into output_dir."""
+    wav = AudioFile(input_path).read(
+        streams=0,
+        samplerate=separator.samplerate,
+        channels=separator.audio_channels
+    )
+
+    # Normalize like the demucs CLI does, then undo it on the estimated stems
+    ref = wav.mean(0)
+    wav -= ref.mean()
+    wav /= ref.std()
+    with torch.no_grad(), inference_context():
+        sources = run_model(separator, wav, segment, overlap, batch_size, on_progress)
+    sources *= ref.std()
+    sources += ref.mean()
+
+    os.makedirs(output_dir, exist_ok=True)
+    for source, name in zip(sources, separator.sources):
+        save_stem(source, os.path.join(output_dir, f"{name}.wav"), separator.samplerate)
+
+    # The instrumental is every non-vocal stem summed, done while still in memory
+    vocals = separator.sources.index("vocals")
+    instrumental = sources.sum(0) - sources[vocals]
+    save_stem(instrumental, os.path.join(output_dir, "instrumental.wav"), separator.samplerate)
+
+
+def save_stem(wav, path, samplerate):
+    """Write a stem as 16-bit PCM WAV, rescaled like demucs' save_audio if it would clip.
+
+    soundfile instead of save_audio, which goes through torchaudio and needs
+    TorchCodec on torchaudio 2.9 and newer.
+    """
+    sf.write(path, prevent_clip(wav).T.numpy(), samplerate, subtype="PCM_16")
+
+
+def upload_hash(uploaded_file):
+    """BLAKE3 digest of the upload, read straight from Streamlit's buffer without a copy."""
+    return blake3(uploaded_file.getbuffer(), max_threads=blake3.AUTO).hexdigest(length=16)
+
+
+@st.cache_resource
+def cache_lock():
+    """One lock per process, shared by every session and rerun, guarding CACHE_DIR."""
+    return threading.Lock()
+
+
+def prune_outputs(keep=MAX_CACHED_SEPARATIONS):
+    """Delete all but the most recently used separations from CACHE_DIR.
+
+    Upload directories left without any separation are removed as well. Uploads
+    holding a live partial tmp directory are still being separated and are
+    skipped, stale partial directories are deleted.
+    """
+    with cache_lock():
+        stale_before = time.time() - PARTIAL_MAX_AGE
+        uploads = []
+        for upload in os.scandir(CACHE_DIR):
+            if not upload.is_dir():
+                continue
+            partials = [entry for entry in os.scandir(upload.path) if entry.name.startswith("tmp")]
+            for entry in partials:
+                if entry.stat().st_mtime < stale_before:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            if not any(os.path.exists(entry.path) for entry in partials):
+                uploads.append(upload)
+
+        separations = [
+            entry
+            for upload in uploads
+            for entry in os.scandir(upload.path)
+            if entry.is_dir()
+        ]
+        separations.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in separations[keep:]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+        for upload in uploads:
+            if not any(entry.is_dir() for entry in os.scandir(upload.path)):
+                shutil.rmtree(upload.path, ignore_errors=True)
+
+
+def run_separation(file_hash, model_name, segment, overlap, preset, uploaded_file, on_progress):
+    """Separate an upload once per content hash and settings, returning its stem paths.
+
+    Finished stems on disk are the cache: a repeat request returns them right
+    away and marks the separation as recently used for prune_outputs.
+    """
+    loaded = load_model(model_name)
+    separator = fast_bag(loaded) if preset == "Speed" else loaded
+    if separator is loaded:
+        # Single-network models have nothing to trim, share the Quality result
+        preset = "Quality"
+    # Longer requests than the model allows run at its maximum, so they share one result
+    segment = min(segment, max_segment(separator))
+    upload_dir = os.path.join(CACHE_DIR, file_hash)
+    output_dir = os.path.join(upload_dir, f"{model_name}-{segment}-{overlap}-{preset.lower()}")
+    stem_paths = {stem: os.path.join(output_dir, f"{stem}.wav") for stem in [*STEMS, "instrumental"]}
+    # Write next to the final directory and rename, so other sessions never see half a result.
+    # Created first, it also keeps prune_outputs away from the upload while we work on it.
+    with cache_lock():
+        if os.path.isdir(output_dir):
+            os.utime(output_dir)
+            return stem_paths
+        os.makedirs(upload_dir, exist_ok=True)
+        partial_dir = tempfile.mkdtemp(dir=upload_dir)
+
+    def report(fraction):
+        # A partial directory that keeps being touched is alive for prune_outputs
+        os.utime(partial_dir)
+        on_progress(fraction)
+
+    try:
+        # Keep the upload next to its stems so other settings can reuse it
+        input_path = os.path.join(upload_dir, "upload" + os.path.splitext(uploaded_file.name)[1].lower())
+        if not os.path.exists(input_path):
+            uploaded_file.seek(0)
+            # Copy inside our partial directory so a session storing the same upload can't
+            # truncate it; whichever replace lands last leaves identical bytes in place
+            copy_path = os.path.join(partial_dir, "upload.part")
+            with open(copy_path, "wb") as f:
+                shutil.copyfileobj(uploaded_file, f, length=1024 * 1024)
+            os.replace(copy_path, input_path)
+
+        batch_size = gpu_batch_size(loaded, model_name, segment) if DEVICE == "cuda" else 1
+        separate_track(separator, input_path, partial_dir, segment, overlap, batch_size, report)
+    except BaseException:
+        # Including Streamlit's rerun and stop, raised from on_progress when the user interrupts
+        with cache_lock():
+            shutil.rmtree(partial_dir, ignore_errors=True)
+        raise
+    with cache_lock():
+        try:
+            os.rename(partial_dir, output_dir)
+        except OSError as error:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            # Another session separated the same upload first, its stems are in place
+            if error.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+
+    # Deleting old separations is recursive I/O, keep it off the script thread
+    threading.Thread(target=prune_outputs, daemon=True).start()
+    return stem_paths
+
+
 st.title("🎵 Vocal Separator")
 st.markdown("""
 Separate vocals from instrumentals using Demucs AI model.
@@ -19,15 +581,38 @@ Works with Python 3.13!
 st.sidebar.header("⚙️ Settings")
 model = st.sidebar.selectbox(
     "Select Model",
-    ["htdemucs", "mdx_extra", "mdx_q"],
+    MODELS,
     help="htdemucs: Best quality, mdx_extra: Good quality, mdx_q: Fastest"
 )
+preset = st.sidebar.radio(
+    "Quality / Speed",
+    ["Quality", "Speed"],
+    horizontal=True,
+    help="Speed trims the four-network ensembles: mdx_extra runs its first network, mdx_q two of its four. "
+         "It has no effect on htdemucs."
+)
+segment = st.sidebar.slider(
+    "Segment length (seconds)",
+    7, 40, DEFAULT_SEGMENT,
+    help="Longer segments are faster but use more memory. htdemucs is capped at 7.8s."
+)
+overlap = st.sidebar.slider(
+    "Overlap",
+    0.0, 0.5, 0.1, step=0.05,
+    help="Overlap between segments. Lower is faster, higher smooths segment boundaries."
+)
+
+# Load the default model in the background while the user picks a file
+if "model_warmed" not in st.session_state:
+    st.session_state.model_warmed = True
+    threading.Thread(target=load_model, args=(MODELS[0],), daemon=True).start()
 
 st.sidebar.markdown("""
 ### About
 This app uses **Demucs** by Meta AI for music source separation.
 It separates vocals from instruments with high accuracy.
 """)
+st.sidebar.caption(f"Running on: {DEVICE.upper()}")
 
 uploaded_file = st.file_uploader(
     "Upload your audio file",
@@ -36,139 +621,97 @@ uploaded_file = st.file_uploader(
 
 if uploaded_file is not None:
     st.subheader("🎧 Original Audio")
-    st.audio(uploaded_file)
+    st.audio(uploaded_file, format=uploaded_file.type or "audio/wav")
 
     if st.button("🚀 Separate Vocals", type="primary"):
         try:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Save uploaded file
-                input_path = os.path.join(temp_dir, uploaded_file.name)
-                with open(input_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-
-                # Run demucs
-                with st.spinner("🎵 Processing audio... This may take a few minutes..."):
-                    # Use demucs to separate vocals
-                    cmd = [
-                        "demucs",
-                        "--two-stems=vocals",
-                        "-n", model,
-                        "-o", temp_dir,
-                        "--mp3",
-                        input_path
-                    ]
-
-                    result = subprocess.run(cmd, capture_output=True, text=True)
-
-                    if result.returncode != 0:
-                        st.error(f"❌ Demucs processing failed: {result.stderr}")
-                    else:
-                        st.success("✅ Separation complete!")
-
-                        # Find output folder
-                        separated_dir = None
-                        for root, dirs, files in os.walk(temp_dir):
-                            if "vocals.mp3" in files:
-                                separated_dir = root
-                                break
-
-                        if separated_dir:
-                            vocals_path = os.path.join(separated_dir, "vocals.mp3")
-                            drums_path = os.path.join(separated_dir, "drums.mp3")
-                            bass_path = os.path.join(separated_dir, "bass.mp3")
-                            other_path = os.path.join(separated_dir, "other.mp3")
-
-                            col1, col2 = st.columns(2)
-
-                            # Display and download vocals
-                            if os.path.exists(vocals_path):
-                                with col1:
-                                    st.markdown("### 🎤 Vocals")
-                                    with open(vocals_path, "rb") as f:
-                                        vocals_data = f.read()
-                                    st.audio(vocals_data, format="audio/mp3")
-                                    st.download_button(
-                                        label="⬇️ Download Vocals",
-                                        data=vocals_data,
-                                        file_name=f"vocals_{uploaded_file.name}",
-                                        mime="audio/mp3"
-                                    )
-
-                            # Display and download instrumental (combination of all non-vocal stems)
-                            if os.path.exists(drums_path) and os.path.exists(bass_path):
-                                with col2:
-                                    st.markdown("### 🎸 Instrumental")
-                                    # For simplicity, show drums as instrumental
-                                    with open(drums_path, "rb") as f:
-                                        instrumental_data = f.read()
-                                    st.audio(instrumental_data, format="audio/mp3")
-                                    st.download_button(
-                                        label="⬇️ Download Instrumental (Drums)",
-                                        data=instrumental_data,
-                                        file_name=f"drums_{uploaded_file.name}",
-                                        mime="audio/mp3"
-                                    )
-
-                            # Show other stems available
-                            st.markdown("---")
-                            st.markdown("### 🎼 Other Stems Available")
-
-                            col1, col2, col3 = st.columns(3)
-
-                            if os.path.exists(drums_path):
-                                with col1:
-                                    with open(drums_path, "rb") as f:
-                                        drums_data = f.read()
-                                    st.markdown("**🥁 Drums**")
-                                    st.download_button(
-                                        label="Download Drums",
-                                        data=drums_data,
-                                        file_name=f"drums_{uploaded_file.name}",
-                                        mime="audio/mp3",
-                                        key="drums"
-                                    )
-
-                            if os.path.exists(bass_path):
-                                with col2:
-                                    with open(bass_path, "rb") as f:
-                                        bass_data = f.read()
-                                    st.markdown("**🎸 Bass**")
-                                    st.download_button(
-                                        label="Download Bass",
-                                        data=bass_data,
-                                        file_name=f"bass_{uploaded_file.name}",
-                                        mime="audio/mp3",
-                                        key="bass"
-                                    )
-
-                            if os.path.exists(other_path):
-                                with col3:
-                                    with open(other_path, "rb") as f:
-                                        other_data = f.read()
-                                    st.markdown("**🎹 Other**")
-                                    st.download_button(
-                                        label="Download Other",
-                                        data=other_data,
-                                        file_name=f"other_{uploaded_file.name}",
-                                        mime="audio/mp3",
-                                        key="other"
-                                    )
-                        else:
-                            st.error("❌ Could not find output files")
-
-        except FileNotFoundError:
-            st.error("""
-            ❌ Demucs is not installed!
-
-            **Local installation:**
-            ```bash
-            pip install demucs
-            ```
-
-            **Streamlit Cloud:**
-            This error shouldn't appear on Streamlit Cloud.
-            Please check the deployment logs.
-            """)
+            # Run demucs
+            with st.spinner("🎵 Processing audio... This may take a few minutes..."):
+                # The same upload with the same settings reuses the earlier stems
+                file_hash = upload_hash(uploaded_file)
+                progress_bar = st.progress(0.0, text="Separating segments...")
+                stem_paths = run_separation(
+                    file_hash,
+                    model,
+                    segment,
+                    overlap,
+                    preset,
+                    uploaded_file,
+                    lambda fraction: progress_bar.progress(fraction, text="Separating segments...")
+                )
+                progress_bar.empty()
+
+                st.success("✅ Separation complete!")
+
+                track_stem = os.path.splitext(uploaded_file.name)[0]
+                download_ext, mp3_quality = download_format(uploaded_file.name)
+                download_mime = f"audio/{download_ext}"
+
+                if all(os.path.exists(path) for path in stem_paths.values()):
+                    col1, col2 = st.columns(2)
+
+                    # Display and download vocals
+                    with col1:
+                        st.markdown("### 🎤 Vocals")
+                        st.audio(stem_paths["vocals"], format="audio/wav")
+                        st.download_button(
+                            label="⬇️ Download Vocals",
+                            data=partial(stem_download, stem_paths["vocals"], mp3_quality),
+                            file_name=f"vocals_{track_stem}.{download_ext}",
+                            mime=download_mime,
+                            on_click="ignore"
+                        )
+
+                    # Display and download instrumental (combination of all non-vocal stems)
+                    with col2:
+                        st.markdown("### 🎸 Instrumental")
+                        st.audio(stem_paths["instrumental"], format="audio/wav")
+                        st.download_button(
+                            label="⬇️ Download Instrumental",
+                            data=partial(stem_download, stem_paths["instrumental"], mp3_quality),
+                            file_name=f"instrumental_{track_stem}.{download_ext}",
+                            mime=download_mime,
+                            on_click="ignore"
+                        )
+
+                    # Show other stems available
+                    st.markdown("---")
+                    st.markdown("### 🎼 Other Stems Available")
+
+                    other_stems = [stem for stem in STEMS if stem != "vocals"]
+                    for col, stem in zip(st.columns(len(other_stems)), other_stems):
+                        with col:
+                            st.markdown(f"**{STEMS[stem]}**")
+                            st.download_button(
+                                label=f"Download {stem.capitalize()}",
+                                data=partial(stem_download, stem_paths[stem], mp3_quality),
+                                file_name=f"{stem}_{track_stem}.{download_ext}",
+                                mime=download_mime,
+                                key=stem,
+                                on_click="ignore"
+                            )
+                else:
+                    st.error("❌ Could not find output files")
+
+        except FileNotFoundError as e:
+            # Raised by subprocess when the decoder or encoder binary is missing
+            if e.filename in ("ffmpeg", "ffprobe"):
+                st.error("""
+                ❌ FFmpeg is not installed!
+
+                Demucs needs FFmpeg to decode the uploaded audio.
+
+                **Local installation:**
+                ```bash
+                sudo apt install ffmpeg
+                ```
+
+                **Streamlit Cloud:**
+                This error shouldn't appear on Streamlit Cloud.
+                Please check that `ffmpeg` is listed in packages.txt.
+                """)
+            else:
+                st.error(f"❌ Error: {str(e)}")
         except Exception as e:
             st.error(f"❌ Error: {str(e)}")
 